@@ -1,20 +1,28 @@
 import os
+import asyncio
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from pathlib import Path
+from urllib.parse import parse_qs
 
-from sync_service import sync_catalog, load_catalog
+from sync_service import run_sync_catalog, get_catalog, search_products
 
 load_dotenv()
 
 SYNC_INTERVAL = int(os.getenv("SYNC_INTERVAL_HOURS", 6))
-scheduler = AsyncIOScheduler()
+PAGE_SIZE = 48
+MAX_PAGE_SIZE = 200
+# El scraping corre en un hilo aparte para no bloquear las peticiones
+scheduler = AsyncIOScheduler(executors={"default": ThreadPoolExecutor(1)})
 
 
 @asynccontextmanager
@@ -25,16 +33,25 @@ async def lifespan(app: FastAPI):
     Path("static/css").mkdir(parents=True, exist_ok=True)
     Path("data").mkdir(exist_ok=True)
     
-    catalog = load_catalog()
+    # Compilar plantillas antes de la primera petición
+    for name in templates.env.list_templates(extensions=["html"]):
+        templates.env.get_template(name)
+    css_path = Path("static/css/styles.css")
+    templates.env.globals["css_version"] = int(css_path.stat().st_mtime) if css_path.exists() else 0
+    
+    catalog = await get_catalog()
     if not catalog.get("last_sync") or catalog.get("stats", {}).get("total_products", 0) == 0:
         print("📦 Primera ejecución - sincronizando catálogo...")
-        sync_catalog()
+        await asyncio.to_thread(run_sync_catalog)
     
     scheduler.add_job(
-        sync_catalog,
+        run_sync_catalog,
         trigger=IntervalTrigger(hours=SYNC_INTERVAL),
         id="sync_catalog",
-        replace_existing=True
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=600
     )
     scheduler.start()
     print(f"⏰ Sincronización programada cada {SYNC_INTERVAL} horas")
@@ -44,19 +61,61 @@ async def lifespan(app: FastAPI):
     scheduler.shutdown()
 
 
-app = FastAPI(title="Catálogo Espejo", lifespan=lifespan)
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+class CachedStaticFiles(StaticFiles):
+    """
+    Archivos estáticos con caché de un año cuando la URL lleva versión (?v=...)
+    Sin versión, el navegador revalida siempre con ETag/Last-Modified
+    """
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if "v" in parse_qs(scope.get("query_string", b"").decode("latin-1")):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
+
+class PageGZipMiddleware(GZipMiddleware):
+    """Comprimir HTML/JSON/CSS; las imágenes ya vienen comprimidas"""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/static/images/"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app = FastAPI(title="Catálogo Espejo", lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(PageGZipMiddleware, minimum_size=1000)
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
+
+# Plantillas compiladas una sola vez y cacheadas en disco entre reinicios
+JINJA_CACHE_DIR = Path("data/jinja_cache")
+JINJA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader("templates"),
+    bytecode_cache=FileSystemBytecodeCache(str(JINJA_CACHE_DIR)),
+    auto_reload=False,
+    cache_size=400,
+    autoescape=True
+))
+
+
+def paginate(items: list, page: int, page_size: int) -> tuple[list, int, int]:
+    """Retorna (items_de_la_pagina, pagina_actual, total_paginas)"""
+    total_pages = max(1, -(-len(items) // page_size))
+    page = max(1, min(page, total_pages))
+    start = (page - 1) * page_size
+    return items[start:start + page_size], page, total_pages
 
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    catalog = load_catalog()
-    # Mostrar últimos 24 productos en home
+    catalog = await get_catalog()
+    # Mostrar últimos productos en home (precalculados por sincronización)
     return templates.TemplateResponse("index.html", {
         "request": request,
         "categories": catalog.get("categories", {}),
-        "products": catalog.get("products", [])[:24],
+        "products": catalog["_home_products"],
         "stats": catalog.get("stats", {}),
         "last_sync": catalog.get("last_sync")
     })
@@ -64,31 +123,17 @@ async def home(request: Request):
 
 @app.get("/categoria/{category_id}", response_class=HTMLResponse)
 async def category_view(request: Request, category_id: int, sub: int = None):
-    catalog = load_catalog()
+    catalog = await get_catalog()
     
-    category = catalog.get("categories", {}).get("all", {}).get(str(category_id))
-    if not category:
-        category = catalog.get("categories", {}).get("all", {}).get(category_id)
+    all_categories = catalog["categories"]["all"]
+    category = all_categories.get(str(category_id))
     if not category:
         raise HTTPException(status_code=404, detail="Categoría no encontrada")
     
     active_category_id = sub if sub else category_id
-    
-    products_by_cat = catalog.get("products_by_category", {})
-    products = products_by_cat.get(str(active_category_id), [])
-    if not products:
-        products = products_by_cat.get(active_category_id, [])
-    
-    children = catalog.get("categories", {}).get("children", {})
-    subcategories = children.get(str(category_id), [])
-    if not subcategories:
-        subcategories = children.get(category_id, [])
-    
-    active_sub = None
-    if sub:
-        active_sub = catalog.get("categories", {}).get("all", {}).get(str(sub))
-        if not active_sub:
-            active_sub = catalog.get("categories", {}).get("all", {}).get(sub)
+    products = catalog["products_by_category"].get(str(active_category_id), [])
+    subcategories = catalog["categories"]["children"].get(str(category_id), [])
+    active_sub = all_categories.get(str(sub)) if sub else None
     
     return templates.TemplateResponse("category.html", {
         "request": request,
@@ -102,46 +147,60 @@ async def category_view(request: Request, category_id: int, sub: int = None):
 
 
 @app.get("/todos", response_class=HTMLResponse)
-async def all_products(request: Request):
-    catalog = load_catalog()
+async def all_products(request: Request, page: int = Query(1, ge=1),
+                       page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    catalog = await get_catalog()
+    products = catalog.get("products", [])
+    page_products, page, total_pages = paginate(products, page, page_size)
     return templates.TemplateResponse("all_products.html", {
         "request": request,
-        "products": catalog.get("products", []),
+        "products": page_products,
         "categories": catalog.get("categories", {}),
-        "total_products": len(catalog.get("products", []))
+        "total_products": len(products),
+        "page": page,
+        "page_size": page_size,
+        "total_pages": total_pages
     })
 
 
 @app.get("/buscar", response_class=HTMLResponse)
-async def search(request: Request, q: str = ""):
-    catalog = load_catalog()
-    results = []
-    if q:
-        q_lower = q.lower()
-        for product in catalog.get("products", []):
-            if (q_lower in product.get("name", "").lower() or 
-                q_lower in product.get("code", "").lower()):
-                results.append(product)
+async def search(request: Request, q: str = "", page: int = Query(1, ge=1),
+                 page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    catalog = await get_catalog()
+    results = search_products(catalog, q) if q else []
+    page_results, page, total_pages = paginate(results, page, page_size)
     
     return templates.TemplateResponse("search.html", {
         "request": request,
         "query": q,
-        "products": results,
+        "products": page_results,
         "categories": catalog.get("categories", {}),
-        "total_products": len(results)
+        "total_products": len(results),
+        "page": page,
+        "page_size": page_size,
+        "total_pages": total_pages
     })
 
 
 @app.post("/api/sync")
 async def manual_sync():
-    success = sync_catalog()
+    success = await asyncio.to_thread(run_sync_catalog)
+    if success is None:
+        return ORJSONResponse(
+            {"success": False, "message": "Sincronización en curso"},
+            status_code=409
+        )
     return {"success": success, "message": "Sincronización completada" if success else "Error"}
 
 
 @app.get("/api/stats")
-async def get_stats():
-    catalog = load_catalog()
-    return {"last_sync": catalog.get("last_sync"), "stats": catalog.get("stats", {})}
+async def get_stats(request: Request):
+    catalog = await get_catalog()
+    # Solo cambia al sincronizar: el cliente revalida con el ETag
+    headers = {"ETag": catalog["_stats_etag"], "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == catalog["_stats_etag"]:
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(catalog["_stats_response"], headers=headers)
 
 
 @app.get("/health")
@@ -152,4 +211,13 @@ async def health_check():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    workers = int(os.getenv("WEB_WORKERS", 1))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        reload=False
+    )
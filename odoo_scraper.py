@@ -2,8 +2,13 @@
 Scraper para Odoo eCommerce (Plan Standard sin API)
 Extrae categorías y productos mediante web scraping
 """
+import asyncio
+import hashlib
 import httpx
-from bs4 import BeautifulSoup
+import aiofiles
+from email.utils import formatdate
+from pathlib import Path
+from selectolax.lexbor import LexborHTMLParser, LexborNode
 import re
 import os
 from typing import Optional
@@ -12,6 +17,24 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+IMAGES_DIR = Path("static/images/products")
+IMAGE_EXT_BY_TYPE = {'image/png': '.png', 'image/webp': '.webp'}
+IMAGE_EXTENSIONS = ('.jpg', *IMAGE_EXT_BY_TYPE.values())
+# Máximo de imágenes descargándose a la vez
+IMAGE_CONCURRENCY = 16
+
+# Patrones precompilados (se usan por cada producto/página)
+_TOTAL_RE = re.compile(r'(\d+)\s*producto', re.IGNORECASE)
+_PAGE_NUM_RE = re.compile(r'page[=/-](\d+)')
+_PAGE_PARAM_RE = re.compile(r'page=\d+')
+_PROD_ID_RE = re.compile(r'-(\d+)(?:\?|$|#)')
+_PRICE_CLEAN_RE = re.compile(r'[^\d.]')
+_CODE_BRACKET_RE = re.compile(r'\[([A-Z]{1,3}-[A-Z]{1,3}-\d+)\]', re.IGNORECASE)
+_CODE_BRACKET_STRIP_RE = re.compile(r'\s*\[[A-Z]{1,3}-[A-Z]{1,3}-\d+\]\s*')
+_CODE_SLUG_RE = re.compile(r'/shop/([a-z]{1,3}-[a-z]{1,3}-\d+)-', re.IGNORECASE)
+_CODE_RE = re.compile(r'^[A-Z]{1,3}-[A-Z]{1,3}-\d+$', re.IGNORECASE)
+_DIGITS_RE = re.compile(r'(\d+)')
+
 # Estructura de categorías fija (basada en tu menú de Odoo)
 CATEGORIES_STRUCTURE = {
     "parents": [
@@ -55,6 +78,8 @@ CATEGORIES_STRUCTURE = {
     }
 }
 
+PARENT_NAME_BY_ID = {p["id"]: p["name"] for p in CATEGORIES_STRUCTURE["parents"]}
+
 
 class OdooScraper:
     def __init__(self):
@@ -65,20 +90,29 @@ class OdooScraper:
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
             "Accept-Language": "es-ES,es;q=0.9,en;q=0.8",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Connection": "keep-alive",
         }
         
-        self.client: Optional[httpx.Client] = None
+        self.client: Optional[httpx.AsyncClient] = None
+        self._hierarchy: Optional[dict] = None
+        # hash(url) -> (ruta local, etag), válido durante una sincronización
+        self._downloaded_images: dict[str, tuple[str, Optional[str]]] = {}
     
-    def connect(self) -> bool:
+    async def connect(self) -> bool:
+        self._downloaded_images = {}
         try:
-            self.client = httpx.Client(
+            # HTTP/2 multiplexa todas las peticiones sobre una conexión reutilizada
+            self.client = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_keepalive_connections=20,
+                    max_connections=20,
+                    keepalive_expiry=60.0
+                ),
                 headers=self.headers,
                 follow_redirects=True,
-                timeout=30.0
+                timeout=httpx.Timeout(10.0, connect=5.0)
             )
-            response = self.client.get(self.shop_url)
+            response = await self.client.get(self.shop_url)
             if response.status_code == 200:
                 print(f"✓ Conectado a {self.base_url}")
                 return True
@@ -89,22 +123,25 @@ class OdooScraper:
             print(f"✗ Error de conexión: {e}")
             return False
     
-    def close(self):
+    async def close(self):
         if self.client:
-            self.client.close()
+            await self.client.aclose()
     
-    def _get_soup(self, url: str) -> Optional[BeautifulSoup]:
+    async def _get_soup(self, url: str) -> Optional[LexborHTMLParser]:
         try:
-            response = self.client.get(url)
+            response = await self.client.get(url)
             if response.status_code == 200:
-                return BeautifulSoup(response.text, 'html.parser')
+                return LexborHTMLParser(response.text)
             return None
         except Exception as e:
             print(f"  Error obteniendo {url}: {e}")
             return None
     
     def get_category_hierarchy(self) -> dict:
-        """Retornar estructura de categorías fija y ordenada"""
+        """Retornar estructura de categorías fija y ordenada (se construye una vez)"""
+        if self._hierarchy is not None:
+            return self._hierarchy
+        
         hierarchy = {
             "parents": [],
             "children": {},
@@ -125,7 +162,7 @@ class OdooScraper:
         
         for parent_id, children in CATEGORIES_STRUCTURE["children"].items():
             hierarchy["children"][parent_id] = []
-            parent_name = next((p["name"] for p in CATEGORIES_STRUCTURE["parents"] if p["id"] == parent_id), None)
+            parent_name = PARENT_NAME_BY_ID.get(parent_id)
             
             for child in children:
                 child_data = {
@@ -139,111 +176,121 @@ class OdooScraper:
                 hierarchy["children"][parent_id].append(child_data)
                 hierarchy["all"][child["id"]] = child_data
         
+        self._hierarchy = hierarchy
         return hierarchy
     
-    def get_products_from_page(self, url: str) -> tuple[list, Optional[str], int]:
+    async def get_products_from_page(self, url: str,
+                                     soup: Optional[LexborHTMLParser] = None) -> tuple[list, Optional[str], int]:
         """
-        Obtener productos de una página del shop
+        Obtener productos de una página del shop (soup: página ya descargada, opcional)
         Retorna: (lista_productos, url_siguiente_pagina, total_productos)
         """
         products = []
         next_page = None
         total = 0
         
-        soup = self._get_soup(url)
+        if soup is None:
+            soup = await self._get_soup(url)
         if not soup:
             return products, next_page, total
         
         # Obtener total de productos de la página
-        total_el = soup.select_one('.o_wsale_products_count, .products_pager strong, .text-muted')
+        total_el = soup.css_first('.o_wsale_products_count, .products_pager strong, .text-muted')
         if total_el:
-            total_text = total_el.get_text()
-            match = re.search(r'(\d+)\s*producto', total_text, re.IGNORECASE)
+            total_text = total_el.text()
+            match = _TOTAL_RE.search(total_text)
             if match:
                 total = int(match.group(1))
         
         # Buscar todos los formularios de producto (estructura Odoo estándar)
-        product_forms = soup.select('form[action*="/shop/cart/update"]')
+        product_forms = soup.css('form[action*="/shop/cart/update"]')
         
         for form in product_forms:
             try:
-                product = self._parse_product_form(form, soup)
+                product = self._parse_product_form(form)
                 if product:
                     products.append(product)
             except Exception as e:
                 print(f"  Error parseando producto: {e}")
                 continue
         
-        # Buscar paginación - múltiples selectores
-        # Método 1: Link directo "Next" o "Siguiente"
-        next_link = soup.select_one('.pagination a[rel="next"], a.page-link[rel="next"], .pagination .next a')
-        if next_link:
-            next_href = next_link.get('href')
-            if next_href:
-                next_page = urljoin(self.base_url, next_href)
-        
-        # Método 2: Si no hay link next, buscar por número de página
-        if not next_page:
-            current_page = 1
-            # Detectar página actual
-            active_page = soup.select_one('.pagination .active a, .pagination .active span')
-            if active_page:
+        # Paginación: una sola consulta y un solo recorrido de los enlaces
+        rel_next_href = None
+        current_page = 1
+        max_page = 1
+        for node in soup.css('.pagination a, .pagination .active span, a.page-link[rel="next"]'):
+            parent_classes = (node.parent.attributes.get('class') or '').split() if node.parent else []
+            href = node.attributes.get('href') or ''
+            
+            # Método 1: Link directo "Next" o "Siguiente"
+            if rel_next_href is None and href and (node.attributes.get('rel') == 'next' or 'next' in parent_classes):
+                rel_next_href = href
+            
+            # Página actual
+            if 'active' in parent_classes:
                 try:
-                    current_page = int(active_page.get_text(strip=True))
-                except:
+                    current_page = int(node.text(strip=True))
+                except ValueError:
                     pass
             
-            # Buscar si hay más páginas
-            page_links = soup.select('.pagination a[href*="page="], .pagination a.page-link')
-            max_page = current_page
-            for link in page_links:
-                href = link.get('href', '')
-                page_match = re.search(r'page[=/-](\d+)', href)
-                if page_match:
-                    page_num = int(page_match.group(1))
-                    if page_num > max_page:
-                        max_page = page_num
-            
-            if max_page > current_page:
-                # Construir URL de siguiente página
-                if '?' in url:
-                    if 'page=' in url:
-                        next_page = re.sub(r'page=\d+', f'page={current_page + 1}', url)
-                    else:
-                        next_page = f"{url}&page={current_page + 1}"
+            page_match = _PAGE_NUM_RE.search(href)
+            if page_match:
+                max_page = max(max_page, int(page_match.group(1)))
+        
+        if rel_next_href:
+            next_page = urljoin(self.base_url, rel_next_href)
+        elif max_page > current_page:
+            # Método 2: construir URL de la siguiente página por número
+            if '?' in url:
+                if 'page=' in url:
+                    next_page = _PAGE_PARAM_RE.sub(f'page={current_page + 1}', url)
                 else:
-                    next_page = f"{url}?page={current_page + 1}"
+                    next_page = f"{url}&page={current_page + 1}"
+            else:
+                next_page = f"{url}?page={current_page + 1}"
         
         return products, next_page, total
     
-    def _parse_product_form(self, form, soup=None) -> Optional[dict]:
-        container = form.find_parent('div', class_='oe_product') or form.find_parent('td') or form
+    @staticmethod
+    def _find_parent(node: LexborNode, tag: str, css_class: Optional[str] = None) -> Optional[LexborNode]:
+        parent = node.parent
+        while parent is not None:
+            if parent.tag == tag and (
+                css_class is None or css_class in (parent.attributes.get('class') or '').split()
+            ):
+                return parent
+            parent = parent.parent
+        return None
+    
+    def _parse_product_form(self, form: LexborNode) -> Optional[dict]:
+        container = self._find_parent(form, 'div', 'oe_product') or self._find_parent(form, 'td') or form
         
-        link = container.select_one('a[href*="/shop/"]')
+        link = container.css_first('a[href*="/shop/"]')
         if not link:
             return None
         
-        href = link.get('href', '')
-        match = re.search(r'-(\d+)(?:\?|$|#)', href)
+        href = link.attributes.get('href') or ''
+        match = _PROD_ID_RE.search(href)
         if not match:
             return None
         
         product_id = int(match.group(1))
         
         # Nombre
-        name_el = container.select_one('h5, h6, .card-title, [itemprop="name"]')
-        name = name_el.get_text(strip=True) if name_el else link.get_text(strip=True)
-        name = re.sub(r'\s+', ' ', name).strip() or "Sin nombre"
+        name_el = container.css_first('h5, h6, .card-title, [itemprop="name"]')
+        name = name_el.text(strip=True) if name_el else link.text(strip=True)
+        # split/join colapsa espacios sin pasar por el motor de regex
+        name = ' '.join(name.split()) or "Sin nombre"
         
         # Precio - manejar formato español (coma como decimal) e inglés (punto)
         price = 0.0
-        price_el = container.select_one('.oe_currency_value')
+        price_el = container.css_first('.oe_currency_value')
         if price_el:
-            price_text = price_el.get_text(strip=True)
+            price_text = price_el.text(strip=True)
             # Reemplazar coma por punto para decimales
             price_text = price_text.replace(',', '.')
             # Limpiar todo excepto números y punto
-            price_clean = re.sub(r'[^\d.]', '', price_text)
+            price_clean = _PRICE_CLEAN_RE.sub('', price_text)
             try:
                 price = float(price_clean) if price_clean else 0.0
             except:
@@ -251,9 +298,9 @@ class OdooScraper:
         
         # Imagen
         image_url = ""
-        img_el = container.select_one('img[src*="/web/image"]')
+        img_el = container.css_first('img[src*="/web/image"]')
         if img_el:
-            image_url = img_el.get('src', '')
+            image_url = img_el.attributes.get('src') or ''
             if image_url and not image_url.startswith('http'):
                 image_url = urljoin(self.base_url, image_url)
         
@@ -261,44 +308,43 @@ class OdooScraper:
         code = ""
         
         # Método 1: Buscar en la URL de la imagen (formato [CODIGO] en el nombre)
-        img_el = container.select_one('img[src*="/web/image"]')
         if img_el:
-            img_src = img_el.get('src', '')
+            img_src = img_el.attributes.get('src') or ''
             # Buscar patrón [XX-XX-000] en la URL de la imagen
-            code_match = re.search(r'\[([A-Z]{1,3}-[A-Z]{1,3}-\d+)\]', img_src, re.IGNORECASE)
+            code_match = _CODE_BRACKET_RE.search(img_src)
             if code_match:
                 code = code_match.group(1).upper()
         
         # Método 2: Buscar en el nombre del producto
         if not code and name:
-            code_match = re.search(r'\[([A-Z]{1,3}-[A-Z]{1,3}-\d+)\]', name, re.IGNORECASE)
+            code_match = _CODE_BRACKET_RE.search(name)
             if code_match:
                 code = code_match.group(1).upper()
                 # Limpiar el nombre quitando el código
-                name = re.sub(r'\s*\[[A-Z]{1,3}-[A-Z]{1,3}-\d+\]\s*', ' ', name).strip()
+                name = _CODE_BRACKET_STRIP_RE.sub(' ', name).strip()
         
         # Método 3: Buscar en href del producto
         if not code and href:
             # El slug puede tener el código: /shop/ac-ar-206-arete-largo...
-            slug_match = re.search(r'/shop/([a-z]{1,3}-[a-z]{1,3}-\d+)-', href, re.IGNORECASE)
+            slug_match = _CODE_SLUG_RE.search(href)
             if slug_match:
                 code = slug_match.group(1).upper()
         
         # Método 4: Buscar en elementos de texto (fallback)
         if not code:
-            for el in container.select('small, .text-muted, span'):
-                text = el.get_text(strip=True)
-                if re.match(r'^[A-Z]{1,3}-[A-Z]{1,3}-\d+$', text, re.IGNORECASE):
+            for el in container.css('small, .text-muted, span'):
+                text = el.text(strip=True)
+                if _CODE_RE.match(text):
                     code = text.upper()
                     break
         
         # Cantidad disponible - buscar en el contenedor o en atributos
         qty_available = 0
         # Intentar obtener de data attributes
-        qty_el = container.select_one('[data-qty-available], .availability')
+        qty_el = container.css_first('[data-qty-available], .availability')
         if qty_el:
-            qty_text = qty_el.get('data-qty-available') or qty_el.get_text(strip=True)
-            qty_match = re.search(r'(\d+)', str(qty_text))
+            qty_text = qty_el.attributes.get('data-qty-available') or qty_el.text(strip=True)
+            qty_match = _DIGITS_RE.search(str(qty_text))
             if qty_match:
                 qty_available = int(qty_match.group(1))
         
@@ -312,15 +358,19 @@ class OdooScraper:
             "qty_available": qty_available
         }
     
-    def get_all_products(self, category_url: Optional[str] = None) -> list:
+    async def get_all_products(self, category_url: Optional[str] = None,
+                               first_page: Optional[LexborHTMLParser] = None) -> list:
         all_products = []
         url = category_url or self.shop_url
+        visited = set()
         page = 1
         total_expected = 0
         
-        while url:
+        while url and url not in visited:
+            visited.add(url)
             print(f"    Página {page}...")
-            products, next_url, total = self.get_products_from_page(url)
+            products, next_url, total = await self.get_products_from_page(url, first_page)
+            first_page = None
             
             if total > 0 and total_expected == 0:
                 total_expected = total
@@ -328,54 +378,138 @@ class OdooScraper:
             
             all_products.extend(products)
             
-            # Si ya tenemos todos los productos esperados, parar
+            # Parar al completar el total esperado o al llegar a una página vacía
             if total_expected > 0 and len(all_products) >= total_expected:
                 break
-            
-            # Si no hay productos nuevos en esta página, intentar forzar siguiente
-            if not products and page < 50:
-                # Intentar construir URL de siguiente página manualmente
-                base = category_url or self.shop_url
-                if '?' in base:
-                    next_url = f"{base}&page={page + 1}"
-                else:
-                    next_url = f"{base}?page={page + 1}"
-                
-                # Verificar si hay productos en esa página
-                test_products, _, _ = self.get_products_from_page(next_url)
-                if not test_products:
-                    break  # No hay más productos
-                products = test_products
-                all_products.extend(products)
+            if not products:
+                break
             
             url = next_url
             page += 1
-            
-            if page > 100:
-                print("    ⚠ Límite de páginas alcanzado")
-                break
         
         return all_products
     
-    def get_products_by_category(self, category_id: int, category_url: str) -> list:
-        return self.get_all_products(category_url)
+    async def get_products_by_category(self, category_id: int, category_url: str,
+                                       validators: Optional[dict] = None) -> Optional[tuple[list, dict]]:
+        """
+        Productos de una categoría, pidiendo la primera página de forma condicional
+        validators: {"etag": ..., "last_modified": ...} de la sincronización anterior
+        Retorna None si la categoría no cambió (HTTP 304); si no, (productos, validadores_nuevos)
+        """
+        headers = {}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        
+        try:
+            response = await self.client.get(category_url, headers=headers)
+        except Exception as e:
+            print(f"  Error obteniendo {category_url}: {e}")
+            return [], {}
+        
+        if response.status_code == 304 and headers:
+            return None
+        if response.status_code != 200:
+            return [], {}
+        
+        new_validators = {}
+        if response.headers.get("etag"):
+            new_validators["etag"] = response.headers["etag"]
+        if response.headers.get("last-modified"):
+            new_validators["last_modified"] = response.headers["last-modified"]
+        
+        products = await self.get_all_products(category_url, LexborHTMLParser(response.text))
+        return products, new_validators
+    
+    @staticmethod
+    def _image_key(image_url: str) -> str:
+        return hashlib.blake2b(image_url.encode(), digest_size=8).hexdigest()
     
-    def download_image(self, image_url: str, product_id: int) -> str:
+    @staticmethod
+    def _find_local_image(product_id: int) -> Optional[Path]:
+        for ext in IMAGE_EXTENSIONS:
+            path = IMAGES_DIR / f"{product_id}{ext}"
+            if path.exists():
+                return path
+        return None
+    
+    @staticmethod
+    def _local_image_url(path: Path) -> str:
+        # La versión solo cambia cuando la imagen se vuelve a descargar,
+        # así el navegador puede cachearla como inmutable
+        return f"/static/images/products/{path.name}?v={int(path.stat().st_mtime)}"
+    
+    async def download_image(self, image_url: str, product_id: int,
+                             etag: Optional[str] = None) -> tuple[str, Optional[str]]:
+        """
+        Descargar imagen del producto
+        Retorna: (ruta_local_o_url_original, etag)
+        """
         if not image_url:
-            return ""
+            return "", None
+        
+        # Si ya existe, pedir solo si cambió desde la última descarga
+        existing = self._find_local_image(product_id)
+        headers = {}
+        if existing:
+            headers['If-Modified-Since'] = formatdate(existing.stat().st_mtime, usegmt=True)
+            if etag:
+                headers['If-None-Match'] = etag
+        
+        tmp_path = None
         try:
-            response = self.client.get(image_url)
-            if response.status_code == 200:
-                content_type = response.headers.get('content-type', '')
-                ext = '.png' if 'png' in content_type else '.webp' if 'webp' in content_type else '.jpg'
-                filename = f"{product_id}{ext}"
-                filepath = f"static/images/products/{filename}"
-                with open(filepath, 'wb') as f:
-                    f.write(response.content)
-                return f"/static/images/products/{filename}"
+            async with self.client.stream('GET', image_url, headers=headers) as response:
+                if response.status_code == 304 and existing:
+                    return self._local_image_url(existing), response.headers.get('etag', etag)
+                if response.status_code == 200:
+                    # Extensión desde las cabeceras, antes de leer el cuerpo (JPEG por defecto)
+                    mime = response.headers.get('content-type', '').split(';')[0].strip().lower()
+                    ext = IMAGE_EXT_BY_TYPE.get(mime, '.jpg')
+                    filepath = IMAGES_DIR / f"{product_id}{ext}"
+                    tmp_path = filepath.with_suffix(f"{ext}.part")
+                    async with aiofiles.open(tmp_path, 'wb') as f:
+                        async for chunk in response.aiter_bytes(65536):
+                            await f.write(chunk)
+                    os.replace(tmp_path, filepath)
+                    # Si cambió el formato, borrar la copia anterior para que no se
+                    # vuelva a validar su ETag contra el archivo equivocado
+                    for old_ext in IMAGE_EXTENSIONS:
+                        if old_ext != ext:
+                            (IMAGES_DIR / f"{product_id}{old_ext}").unlink(missing_ok=True)
+                    return self._local_image_url(filepath), response.headers.get('etag')
         except Exception as e:
             print(f"  Error descargando imagen {product_id}: {e}")
-        return image_url
+            # No dejar descargas a medias en el directorio público
+            if tmp_path is not None:
+                tmp_path.unlink(missing_ok=True)
+        return image_url, etag
+    
+    async def download_images(self, items: list[tuple[str, int, Optional[str]]]) -> list[tuple[str, Optional[str]]]:
+        """
+        Descargar imágenes en paralelo, sin repetir URLs ya descargadas
+        items: [(image_url, product_id, etag_anterior), ...] -> [(ruta_local, etag), ...] en el mismo orden
+        """
+        pending = {}
+        for image_url, product_id, etag in items:
+            key = self._image_key(image_url)
+            if key not in self._downloaded_images and key not in pending:
+                pending[key] = (image_url, product_id, etag)
+        
+        semaphore = asyncio.Semaphore(IMAGE_CONCURRENCY)
+        
+        async def bounded(image_url: str, product_id: int, etag: Optional[str]) -> tuple[str, Optional[str]]:
+            async with semaphore:
+                return await self.download_image(image_url, product_id, etag)
+        
+        results = await asyncio.gather(*(bounded(*item) for item in pending.values()))
+        self._downloaded_images.update(zip(pending, results))
+        
+        return [
+            self._downloaded_images.get(self._image_key(url), (url, etag))
+            for url, _, etag in items
+        ]
 
 
 odoo_scraper = OdooScraper()
@@ -1,14 +1,35 @@
 """
 Servicio de sincronización mediante web scraping
 """
-import json
+import asyncio
+import os
+import threading
+import orjson
 from datetime import datetime
 from pathlib import Path
+from typing import Optional
 from odoo_scraper import odoo_scraper
-import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
 
 DATA_DIR = Path("data")
 IMAGES_DIR = Path("static/images/products")
+# Máximo de categorías descargándose a la vez (también limita la carga sobre Odoo)
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", 8))
+# Productos que se muestran en la portada
+HOME_PRODUCTS = 24
+CATALOG_PATH = DATA_DIR / "catalog.json"
+SYNC_LOCK_PATH = DATA_DIR / "sync.lock"
+
+# Catálogo parseado en memoria; se recarga solo cuando cambia el archivo
+_CATALOG_CACHE = {"data": None, "mtime": 0}
+_catalog_lock = asyncio.Lock()
+# Evita dos sincronizaciones simultáneas (programada + manual) en este proceso;
+# entre workers de uvicorn se usa además un flock sobre SYNC_LOCK_PATH
+_sync_lock = threading.Lock()
 
 
 def ensure_directories():
@@ -16,7 +37,7 @@ def ensure_directories():
     IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def sync_catalog():
+async def sync_catalog():
     """Sincronizar catálogo completo desde Odoo mediante scraping"""
     print(f"\n{'='*50}")
     print(f"Iniciando sincronización: {datetime.now().isoformat()}")
@@ -24,11 +45,22 @@ def sync_catalog():
     
     ensure_directories()
     
-    if not odoo_scraper.connect():
+    if not await odoo_scraper.connect():
         print("✗ No se pudo conectar a Odoo")
         return False
     
     try:
+        # ETags de imágenes de la sincronización anterior (para pedidos condicionales)
+        previous_catalog = load_catalog()
+        image_etags = {
+            prod["id"]: prod["image_etag"]
+            for prod in previous_catalog.get("products", [])
+            if prod.get("image_etag")
+        }
+        # Validadores HTTP por categoría: si Odoo responde 304 se reutilizan sus productos
+        previous_by_category = previous_catalog.get("products_by_category", {})
+        previous_validators = previous_catalog.get("category_validators", {})
+        
         print("\n→ Cargando estructura de categorías...")
         category_tree = odoo_scraper.get_category_hierarchy()
         total_categories = len(category_tree["all"])
@@ -37,44 +69,74 @@ def sync_catalog():
         print("\n→ Obteniendo productos por categoría...")
         all_products = []
         products_by_category = {}
-        seen_product_ids = set()
+        # id -> producto canónico (el mismo objeto en products y products_by_category)
+        products_by_id = {}
+        
+        # Descargar todas las subcategorías en paralelo (acotado por semáforo)
+        semaphore = asyncio.Semaphore(SCRAPE_CONCURRENCY)
         
-        # Recorrer todas las subcategorías
+        async def scrape_category(child: dict) -> tuple[list, dict]:
+            key = str(child["id"])
+            # Solo se pide condicional si hay productos previos para reutilizar
+            validators = previous_validators.get(key) if previous_by_category.get(key) else None
+            async with semaphore:
+                print(f"    → {child['name']}...")
+                result = await odoo_scraper.get_products_by_category(child["id"], child["url"], validators)
+            if result is None:
+                print(f"    {child['name']}: sin cambios")
+                return previous_by_category[key], validators
+            return result
+        
+        # Una sola descarga por categoría aunque aparezca en varios menús
+        targets = []
+        seen_categories = set()
         for parent_id, children in category_tree["children"].items():
-            parent_name = category_tree["all"][parent_id]["name"]
-            print(f"\n  [{parent_name}]")
-            
             for child in children:
-                cat_id = child["id"]
-                cat_url = child["url"]
-                print(f"    → {child['name']}...")
-                
-                products = odoo_scraper.get_products_by_category(cat_id, cat_url)
-                products_by_category[cat_id] = []
-                
-                for prod in products:
-                    prod_id = prod['id']
-                    
-                    if 'category_ids' not in prod:
-                        prod['category_ids'] = []
-                    if cat_id not in prod['category_ids']:
-                        prod['category_ids'].append(cat_id)
-                    if parent_id not in prod['category_ids']:
-                        prod['category_ids'].append(parent_id)
-                    
-                    # Descargar imagen si es nuevo
-                    if prod.get('image_url') and prod_id not in seen_product_ids:
-                        local_image = odoo_scraper.download_image(prod['image_url'], prod_id)
-                        prod['image_url'] = local_image
-                    
-                    if prod_id not in seen_product_ids:
-                        seen_product_ids.add(prod_id)
-                        all_products.append(prod)
-                    
-                    products_by_category[cat_id].append(prod)
+                if child["id"] in seen_categories or child["url"] in seen_categories:
+                    continue
+                seen_categories.update((child["id"], child["url"]))
+                targets.append((parent_id, child))
+        results = await asyncio.gather(*(scrape_category(child) for _, child in targets))
+        
+        category_validators = {}
+        current_parent = None
+        for (parent_id, child), (products, validators) in zip(targets, results):
+            if parent_id != current_parent:
+                current_parent = parent_id
+                print(f"\n  [{category_tree['all'][parent_id]['name']}]")
+            
+            cat_id = child["id"]
+            print(f"    {child['name']}: {len(products)} productos")
+            products_by_category[cat_id] = []
+            if validators:
+                category_validators[cat_id] = validators
+            
+            for prod in products:
+                existing = products_by_id.get(prod['id'])
+                if existing is None:
+                    prod['category_ids'] = []
+                    products_by_id[prod['id']] = prod
+                    all_products.append(prod)
+                    existing = prod
                 
-                print(f"      {len(products)} productos")
-                time.sleep(0.3)
+                # Producto repetido: se suman categorías al ya registrado
+                if cat_id not in existing['category_ids']:
+                    existing['category_ids'].append(cat_id)
+                    products_by_category[cat_id].append(existing)
+                if parent_id not in existing['category_ids']:
+                    existing['category_ids'].append(parent_id)
+        
+        # Descargar todas las imágenes en un solo lote paralelo
+        print("\n→ Descargando imágenes...")
+        # Los productos reutilizados ya tienen la imagen local
+        with_image = [prod for prod in all_products if prod.get('image_url', '').startswith('http')]
+        downloaded = await odoo_scraper.download_images(
+            [(prod['image_url'], prod['id'], image_etags.get(prod['id'])) for prod in with_image]
+        )
+        for prod, (local_image, etag) in zip(with_image, downloaded):
+            prod['image_url'] = local_image
+            if etag:
+                prod['image_etag'] = etag
         
         # Ordenar productos por ID descendente (más recientes primero)
         all_products.sort(key=lambda x: x['id'], reverse=True)
@@ -86,6 +148,7 @@ def sync_catalog():
             "categories": category_tree,
             "products": all_products,
             "products_by_category": products_by_category,
+            "category_validators": category_validators,
             "stats": {
                 "total_products": len(all_products),
                 "total_categories": total_categories,
@@ -93,8 +156,13 @@ def sync_catalog():
             }
         }
         
-        with open(DATA_DIR / "catalog.json", 'w', encoding='utf-8') as f:
-            json.dump(catalog_data, f, ensure_ascii=False, indent=2)
+        # Escribir a un temporal y renombrar: los lectores nunca ven un archivo a medias
+        tmp_path = CATALOG_PATH.with_suffix('.json.tmp')
+        tmp_path.write_bytes(
+            orjson.dumps(catalog_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        )
+        os.replace(tmp_path, CATALOG_PATH)
+        invalidate_catalog_cache()
         
         print(f"\n✓ Sincronización completada")
         print(f"  - Productos: {catalog_data['stats']['total_products']}")
@@ -108,11 +176,39 @@ def sync_catalog():
         traceback.print_exc()
         return False
     finally:
-        odoo_scraper.close()
+        await odoo_scraper.close()
+
+
+def run_sync_catalog() -> Optional[bool]:
+    """
+    Ejecutar sync_catalog en un event loop propio, pensado para correr en un hilo
+    y no bloquear el loop del servidor web
+    Retorna True/False según el resultado, o None si ya había otra sincronización en curso
+    """
+    if not _sync_lock.acquire(blocking=False):
+        print("⚠ Ya hay una sincronización en curso")
+        return None
+    try:
+        ensure_directories()
+        with open(SYNC_LOCK_PATH, 'w') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    print("⚠ Otro proceso ya está sincronizando")
+                    return None
+            return asyncio.run(sync_catalog())
+    finally:
+        _sync_lock.release()
 
 
 def load_catalog() -> dict:
-    catalog_path = DATA_DIR / "catalog.json"
+    """
+    Leer catalog.json de disco y devolver una copia nueva
+    Las peticiones web deben usar get_catalog(); sync_catalog usa esta copia
+    porque modifica los productos que reutiliza de la sincronización anterior
+    """
+    catalog_path = CATALOG_PATH
     
     if not catalog_path.exists():
         return {
@@ -124,8 +220,7 @@ def load_catalog() -> dict:
         }
     
     try:
-        with open(catalog_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return orjson.loads(catalog_path.read_bytes())
     except:
         return {
             "last_sync": None,
@@ -136,5 +231,100 @@ def load_catalog() -> dict:
         }
 
 
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def build_search_index(products: list) -> dict:
+    """Índice invertido de trigramas (nombre y código) -> posiciones en products"""
+    index = {"name": {}, "code": {}}
+    for pos, prod in enumerate(products):
+        for tri in _trigrams(prod["_name_lc"]):
+            index["name"].setdefault(tri, set()).add(pos)
+        for tri in _trigrams(prod["_code_lc"]):
+            index["code"].setdefault(tri, set()).add(pos)
+    return index
+
+
+def search_products(catalog: dict, query: str) -> list:
+    """Buscar productos cuyo nombre o código contenga query"""
+    products = catalog.get("products", [])
+    q_lower = query.lower()
+    index = catalog.get("_search_index")
+    
+    if len(q_lower) < 3 or index is None:
+        # Consultas cortas: no hay trigramas, recorrido lineal
+        candidates = range(len(products))
+    else:
+        grams = _trigrams(q_lower)
+        found = set()
+        for postings in (index["name"], index["code"]):
+            sets = [postings.get(tri) for tri in grams]
+            if all(sets):
+                found |= set.intersection(*sets)
+        candidates = sorted(found)
+    
+    # Verificar la subcadena real: los trigramas pueden coincidir en distinto orden
+    return [
+        products[pos] for pos in candidates
+        if q_lower in products[pos]["_name_lc"] or q_lower in products[pos]["_code_lc"]
+    ]
+
+
+def _prepare_catalog(catalog: dict) -> dict:
+    """Estructuras derivadas que se calculan una vez por carga del catálogo"""
+    # Claves siempre como string, sin importar si vienen de JSON o de memoria
+    categories = catalog.setdefault("categories", {})
+    categories["all"] = {str(k): v for k, v in categories.get("all", {}).items()}
+    categories["children"] = {str(k): v for k, v in categories.get("children", {}).items()}
+    catalog["products_by_category"] = {
+        str(k): v for k, v in catalog.get("products_by_category", {}).items()
+    }
+    # Nombre/código en minúsculas una sola vez, no en cada búsqueda
+    for prod in catalog.get("products", []):
+        prod["_name_lc"] = (prod.get("name") or "").lower()
+        prod["_code_lc"] = (prod.get("code") or "").lower()
+    catalog["_search_index"] = build_search_index(catalog.get("products", []))
+    
+    # Objetos servidos tal cual en cada petición (no se copian)
+    catalog["_home_products"] = catalog.get("products", [])[:HOME_PRODUCTS]
+    catalog["_stats_response"] = {
+        "last_sync": catalog.get("last_sync"),
+        "stats": catalog.get("stats", {})
+    }
+    catalog["_stats_etag"] = f'"{catalog.get("last_sync") or "none"}"'
+    return catalog
+
+
+def invalidate_catalog_cache():
+    """Forzar recarga del catálogo en la próxima petición"""
+    _CATALOG_CACHE["data"] = None
+    _CATALOG_CACHE["mtime"] = 0
+
+
+def _catalog_mtime() -> int:
+    try:
+        return CATALOG_PATH.stat().st_mtime_ns
+    except OSError:
+        return 0
+
+
+async def get_catalog() -> dict:
+    """
+    Catálogo cacheado en memoria (compartido entre peticiones, no modificar)
+    Solo se vuelve a leer de disco si cambió el mtime del archivo
+    """
+    mtime = _catalog_mtime()
+    if _CATALOG_CACHE["data"] is not None and _CATALOG_CACHE["mtime"] == mtime:
+        return _CATALOG_CACHE["data"]
+    
+    async with _catalog_lock:
+        # Otra petición pudo haberlo recargado mientras esperábamos
+        if _CATALOG_CACHE["data"] is None or _CATALOG_CACHE["mtime"] != mtime:
+            _CATALOG_CACHE["data"] = _prepare_catalog(load_catalog())
+            _CATALOG_CACHE["mtime"] = mtime
+        return _CATALOG_CACHE["data"]
+
+
 if __name__ == "__main__":
-    sync_catalog()
+    run_sync_catalog()